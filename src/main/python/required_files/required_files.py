@@ -1,26 +1,99 @@
+import atexit
+import hashlib
 import os
 import re
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
+import uuid
 from abc import ABC, abstractmethod
 from logging import getLogger
 from os import PathLike
 from pathlib import Path
 from typing import BinaryIO, Union
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 
 import bs4
 import requests
+from urllib3.util import make_headers
 
 try:
     from requests_file import FileAdapter
 except ImportError:  # pragma: no cover
     FileAdapter = None
 
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import bsdiff4
+except ImportError:  # pragma: no cover
+    bsdiff4 = None
+
 
 LOGGER = getLogger('required-files')
 LOGGER.setLevel('INFO')
 
+# One background update per versions directory, shared between all instances pointing to it.
+_UPDATE_THREADS = {}
+_UPDATE_LOCK = threading.Lock()
+# Temporary entries of the updates running in this process, so garbage collection leaves them alone.
+_UPDATE_TMP_PATHS = set()
+# How long (in seconds) an exiting process waits for its running background updates. Set to 0 to exit immediately.
+UPDATE_JOIN_TIMEOUT = 60
+
+# Every content-encoding the installed urllib3 can decode (gzip & deflate, br & zstd depending on its extras).
+ACCEPT_ENCODING = make_headers(accept_encoding=True)['accept-encoding']
+CHUNK_SIZE = 1024 * 1024
+
+
+def _session() -> requests.Session:
+    s = requests.Session()
+    s.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    if FileAdapter:
+        s.mount('file://', FileAdapter())
+
+    return s
+
+
+def _apply_zstd_patch(old: bytes, patch: BinaryIO, save_to: BinaryIO) -> None:
+    """Applies a patch created by `zstd --patch-from=old`."""
+    if not zstandard:
+        raise ValueError('`zstandard` is needed to apply zstd patches')
+
+    dictionary = zstandard.ZstdCompressionDict(old, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    zstandard.ZstdDecompressor(dict_data=dictionary, max_window_size=1 << 31).copy_stream(patch, save_to)
+
+
+def _apply_bsdiff_patch(old: bytes, patch: BinaryIO, save_to: BinaryIO) -> None:
+    """Applies a patch created by `bsdiff`."""
+    if not bsdiff4:
+        raise ValueError('`bsdiff4` is needed to apply bsdiff patches')
+
+    save_to.write(bsdiff4.patch(old, patch.read()))
+
+
+PATCHERS = {
+    '.zst': _apply_zstd_patch,
+    '.zstd': _apply_zstd_patch,
+    '.bsdiff': _apply_bsdiff_patch,
+}
+
+
+@atexit.register
+def _join_update_threads() -> None:
+    """Gives the background updates a chance to finish instead of being killed halfway when the process exits."""
+    deadline = time.monotonic() + UPDATE_JOIN_TIMEOUT
+    with _UPDATE_LOCK:
+        threads = list(_UPDATE_THREADS.values())
+
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+
 
 class Required(ABC):
     @abstractmethod
@@ -65,7 +138,7 @@ class RequiredFile(Required):
         tmp_fp = tempfile.TemporaryFile('wb+')
         try:
             RequiredFile._download(url, tmp_fp)
-        except ValueError:
+        except Exception:
             tmp_fp.close()
             raise
 
@@ -74,26 +147,46 @@ class RequiredFile(Required):
 
     @staticmethod
     def _download(url, save_to: Union[str, os.PathLike, BinaryIO]) -> None:
-        with requests.Session() as s:
-            if FileAdapter:
-                s.mount('file://', FileAdapter())
-
-            r = s.get(url)
+        with _session() as s, s.get(url, stream=True) as r:
             if not r:
                 raise ValueError(r.content.decode('utf8'))
 
+            # iter_content undoes any Content-Encoding chunk by chunk, so the body is never fully held in memory.
             if isinstance(save_to, str) or isinstance(save_to, PathLike):
-                with open(save_to, 'wb') as fp:
-                    fp.write(r.content)
+                # Stream next to the target and move it in place once complete: a broken transfer leaves nothing.
+                #   Not `mkstemp`: that one is owner-only, while mode 0o666 lets the umask decide like `open` does.
+                tmp_name = os.path.join(
+                    os.path.dirname(os.path.abspath(save_to)),
+                    f'.{os.path.basename(save_to)}.{uuid.uuid4().hex}.part',
+                )
+                fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+                try:
+                    with os.fdopen(fd, 'wb') as fp:
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            fp.write(chunk)
+                    os.replace(tmp_name, save_to)
+                except BaseException:
+                    os.unlink(tmp_name)
+                    raise
             else:
-                save_to.write(r.content)
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    save_to.write(chunk)
 
     def _return_result(self):
         return Path(self.filename).absolute()
 
+    def _fetch(self, url: str, target: Path) -> None:
+        """Retrieves `url` and installs it as `target`."""
+        self._download(url, target)
+
+    def _install(self, source: Path, target: Path) -> None:
+        """Installs the already downloaded `source` as `target`."""
+        # A copy, not a link: changing the installed file should not change the archive that deltas are applied to.
+        shutil.copyfile(source, target)
+
     def check(self) -> Union[str, Path]:
         if not self._is_file_present():
-            self._download(self.url, self.filename)
+            self._fetch(self.url, self.filename)
 
         return self._return_result()
 
@@ -176,16 +269,70 @@ class RequiredZipFile(ZipfileMixin, RequiredFile):
         self._zip_init(file_to_check)
         self.skip_initial_dir = skip_initial_dir
 
-    def check(self) -> Union[str, Path]:
-        if not self._is_file_present():
-            self._process_zip(
-                self._download_to_tmpfile(self.url), into_dir=self.filename, skip_initial_dir=self.skip_initial_dir
-            )
+    def _fetch(self, url: str, target: Path) -> None:
+        os.makedirs(target, exist_ok=True)
+        self._process_zip(self._download_to_tmpfile(url), into_dir=target, skip_initial_dir=self.skip_initial_dir)
 
-        return self._return_result()
+    def _install(self, source: Path, target: Path) -> None:
+        os.makedirs(target, exist_ok=True)
+        self._process_zip(open(source, 'rb'), into_dir=target, skip_initial_dir=self.skip_initial_dir)
 
 
 class RequiredLatestFromWebMixin(ABC):
+    """
+    Resolves the real download URL from a release page.
+
+    In background update mode every release is installed into its own directory under `<save_as>.versions`,
+      and a `current` symlink points to the active one. `check()` then returns the installed path immediately
+      and looks for a newer release on a background thread. Once that one is installed, the symlink is swapped
+      atomically and older versions are garbage-collected. An exiting process waits for a running update, but at
+      most `UPDATE_JOIN_TIMEOUT` seconds.
+
+    When a `delta_url` is given as well, the downloaded release is kept next to its installation. An upgrade then
+      first tries to download a binary patch against it (`zstd --patch-from` or `bsdiff`, depending on the extension
+      of the patch URL). The patched release is only installed when it matches the sha256 digest published at
+      `<release url>.sha256`; without such a digest, or when anything fails, the full release is downloaded.
+    """
+
+    CURRENT = 'current'
+    ARCHIVE = '.archive'
+    ARCHIVE_SHA256 = '.sha256'
+    SOURCE_URL = '.url'
+    DIGEST_SUFFIX = '.sha256'
+
+    # Subclasses with their own __init__ (not calling `_latest_init`) keep the original behaviour.
+    background_update = False
+    delta_url = None
+    _update_thread = None
+
+    # Multiple inheritance can't handle different arguments to __init__, see ZipfileMixin._zip_init.
+    def _latest_init(self, save_as, background_update=False, keep_versions=2, update_interval=3600, delta_url=None):
+        """
+        :param save_as: Where the non-versioned file/directory would be saved.
+        :param background_update: Install new releases in the background instead of only when missing?
+        :param keep_versions: How many installed versions to retain (the current one is always kept). At least 2:
+            another process may have just installed a newer version, but not yet switched to it.
+        :param update_interval: Minimum number of seconds between two background checks for a new release.
+        :param delta_url: Format string for the URL of a patch from the installed to the new release.
+            Available fields: `url`, `name`, `tag`, `old_url`, `old_name` and `old_tag`. The tag is the directory
+            the release is in (the release tag on GitHub). Eg: '{url}.from-{old_tag}.zst'.
+            Only used together with `background_update`.
+        """
+        self.background_update = background_update
+        self.delta_url = delta_url
+        self.keep_versions = max(keep_versions, 2)
+        self.update_interval = update_interval
+        self._update_thread = None
+
+        base = Path(save_as)
+        self._base_name = base.name
+        self._versions_dir = base.parent / f'{base.name}.versions'
+
+        if background_update:
+            save_as = self._versions_dir / self.CURRENT / self._base_name
+
+        return save_as
+
     @abstractmethod
     def _get_real_url(self, soup: bs4.BeautifulSoup):
         """Returns the real URL based on a parsed HTML file."""
@@ -195,11 +342,221 @@ class RequiredLatestFromWebMixin(ABC):
         """Checks if the filename is OK to use."""
 
     def figure_out_url(self, url):
-        r = requests.get(url)
+        with _session() as s:
+            r = s.get(url)
         soup = bs4.BeautifulSoup(r.content, features='lxml')
         return self._get_real_url(soup)
 
+    def _create_directories(self):
+        if self.background_update:
+            os.makedirs(self._versions_dir, exist_ok=True)
+        else:
+            super()._create_directories()
+
+    @staticmethod
+    def _version_of(url: str) -> str:
+        """The directory name under which the release found at `url` is installed."""
+        return hashlib.sha1(url.encode('utf8')).hexdigest()[:16]
+
+    def _is_update_due(self) -> bool:
+        stamp = self._versions_dir / '.last-update'
+        try:
+            return time.time() - stamp.stat().st_mtime >= self.update_interval
+        except FileNotFoundError:
+            return True
+
+    def _switch_current(self, version: str) -> None:
+        """Points the `current` symlink to `version` in one atomic rename."""
+        current = self._versions_dir / self.CURRENT
+        if os.path.islink(current) and os.readlink(current) == version:
+            return
+
+        tmp_link = self._versions_dir / f'.{self.CURRENT}-{os.getpid()}-{threading.get_ident()}'
+        _UPDATE_TMP_PATHS.add(os.path.abspath(tmp_link))
+        try:
+            os.symlink(version, tmp_link, target_is_directory=True)
+            os.replace(tmp_link, current)
+        finally:
+            _UPDATE_TMP_PATHS.discard(os.path.abspath(tmp_link))
+        LOGGER.info(f'Switched {current} to version {version}')
+
+    @staticmethod
+    def _is_stale(entry: os.DirEntry) -> bool:
+        """Is this temporary entry left behind by an update that is no longer running?"""
+        match = re.match(r'\.(?:tmp|current)-(\d+)-', entry.name)
+        if not match:
+            return False
+
+        pid = int(match.group(1))
+        if pid == os.getpid():
+            return os.path.abspath(entry.path) not in _UPDATE_TMP_PATHS
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:  # It exists, but belongs to somebody else.
+            return False
+
+        return False
+
+    def _collect_garbage(self) -> None:
+        """
+        Removes all but the `keep_versions` most recent versions. The current version is never removed.
+        Also removes what interrupted updates left behind.
+        """
+        for entry in os.scandir(self._versions_dir):
+            if self._is_stale(entry):
+                LOGGER.info(f'Removing leftover {entry.path}')
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.unlink(entry.path)
+
+        current = os.readlink(self._versions_dir / self.CURRENT)
+        versions = sorted(
+            (entry for entry in os.scandir(self._versions_dir) if entry.is_dir(follow_symlinks=False)
+             and not entry.name.startswith('.') and entry.name != current),
+            key=lambda entry: entry.stat(follow_symlinks=False).st_mtime,
+            reverse=True,
+        )
+        for entry in versions[self.keep_versions - 1:]:
+            LOGGER.info(f'Removing old version {entry.path}')
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    @staticmethod
+    def _sha256_of(path: Path) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+
+        return sha256.hexdigest()
+
+    def _published_digest(self, url: str) -> str:
+        """The sha256 published next to the release at `url` (`sha256sum` output or just the digest)."""
+        with self._download_to_tmpfile(url + self.DIGEST_SUFFIX) as fp:
+            digest = fp.read().decode('utf8').split()[:1]
+
+        if not digest or not re.fullmatch('[0-9a-fA-F]{64}', digest[0]):
+            raise ValueError(f'No sha256 digest found at {url}{self.DIGEST_SUFFIX}')
+
+        return digest[0].lower()
+
+    def _download_delta(self, old_url: str, old_archive: Path, url: str, archive: Path) -> None:
+        """Reconstructs the release at `url` as `archive`, by patching the `old_archive` downloaded from `old_url`."""
+        # Patches (bsdiff in particular) carry no checksum, and applied to the wrong base they still produce a file
+        #   of the right size. So only a result matching the published digest is good enough.
+        if self._sha256_of(old_archive) != (old_archive.parent / self.ARCHIVE_SHA256).read_text():
+            raise ValueError(f'{old_archive} changed since it was downloaded')
+
+        path, old_path = urlparse(url).path, urlparse(old_url).path
+        patch_url = self.delta_url.format(
+            url=url,
+            name=os.path.basename(path),
+            tag=os.path.basename(os.path.dirname(path)),
+            old_url=old_url,
+            old_name=os.path.basename(old_path),
+            old_tag=os.path.basename(os.path.dirname(old_path)),
+        )
+        extension = os.path.splitext(urlparse(patch_url).path)[1].lower()
+        if extension not in PATCHERS:
+            raise ValueError(f"Don't know how to apply a '{extension}' patch")
+
+        expected_digest = self._published_digest(url)
+
+        with self._download_to_tmpfile(patch_url) as patch_fp, open(archive, 'wb') as fp:
+            PATCHERS[extension](old_archive.read_bytes(), patch_fp, fp)
+
+        if self._sha256_of(archive) != expected_digest:
+            raise ValueError(f'Patching with {patch_url} did not produce the release at {url}')
+
+        LOGGER.info(f'Patched {old_url} into {url} using {patch_url}')
+
+    def _fetch_release(self, url: str, into_dir: Path) -> None:
+        """Installs the release at `url` in `into_dir`, keeping the downloaded archive for later deltas."""
+        archive = into_dir / self.ARCHIVE
+        target = into_dir / self._base_name
+        previous = self._versions_dir / self.CURRENT
+
+        try:
+            self._download_delta((previous / self.SOURCE_URL).read_text(), previous / self.ARCHIVE, url, archive)
+            self._install(archive, target)
+        except Exception as e:
+            LOGGER.info(f'No delta update possible ({e}), downloading the full release')
+            if target.is_dir():
+                shutil.rmtree(target)
+            elif target.exists():
+                target.unlink()
+
+            self._download(url, archive)
+            self._install(archive, target)
+
+        (into_dir / self.ARCHIVE_SHA256).write_text(self._sha256_of(archive))
+        (into_dir / self.SOURCE_URL).write_text(url)
+
+    def _update(self) -> None:
+        """Installs the latest release (if it isn't already) and makes it the current one."""
+        # Stamp before resolving: a failing release page should be retried after `update_interval` as well.
+        (self._versions_dir / '.last-update').touch()
+        url = self.figure_out_url(self.url)
+
+        version = self._version_of(url)
+        version_dir = self._versions_dir / version
+        if not version_dir.exists():
+            # Install into a temporary directory first, so a version directory is always complete.
+            #   Not `mkdtemp`: that one is owner-only, while `mkdir` lets the umask decide like `makedirs` does.
+            tmp_dir = self._versions_dir / f'.tmp-{os.getpid()}-{uuid.uuid4().hex}'
+            os.mkdir(tmp_dir)
+            _UPDATE_TMP_PATHS.add(os.path.abspath(tmp_dir))
+            try:
+                if self.delta_url:
+                    self._fetch_release(url, tmp_dir)
+                else:
+                    self._fetch(url, tmp_dir / self._base_name)
+                os.rename(tmp_dir, version_dir)
+            except OSError:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                if not version_dir.exists():  # Not installed concurrently by somebody else?
+                    raise
+            except Exception:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            finally:
+                _UPDATE_TMP_PATHS.discard(os.path.abspath(tmp_dir))
+
+        self._switch_current(version)
+        self._collect_garbage()
+
+    def _update_in_background(self) -> None:
+        try:
+            self._update()
+        except Exception as e:
+            LOGGER.warning(f'Background update of {self._versions_dir} failed: {e}')
+
+    def _start_background_update(self) -> threading.Thread:
+        key = str(self._versions_dir.absolute())
+        with _UPDATE_LOCK:
+            thread = _UPDATE_THREADS.get(key)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(
+                    target=self._update_in_background, name=f'required-files-update-{self._base_name}', daemon=True
+                )
+                _UPDATE_THREADS[key] = thread
+                thread.start()
+
+        self._update_thread = thread
+        return thread
+
     def check(self) -> Union[str, Path]:
+        if self.background_update:
+            if not self._is_file_present():
+                self._update()  # Nothing installed yet: there is nothing to return but the downloaded version.
+            elif self._is_update_due():
+                self._start_background_update()
+
+            return self._return_result()
+
         if not self._is_file_present():
             self.url = self.figure_out_url(self.url)
 
@@ -242,7 +599,17 @@ class RequiredLatestBitbucketFile(BitBucketURLRetrieverMixin, RequiredLatestFrom
     """
     This class fetches a file from Bitbucket according to a pattern
     """
-    def __init__(self, url, save_as, file_regex):
+    def __init__(
+        self,
+        url,
+        save_as,
+        file_regex,
+        background_update=False,
+        keep_versions=2,
+        update_interval=3600,
+        delta_url=None,
+    ):
+        save_as = self._latest_init(save_as, background_update, keep_versions, update_interval, delta_url)
         super().__init__(url, save_as)
         self.file_regex = re.compile(file_regex)
 
@@ -254,6 +621,20 @@ class RequiredLatestGithubZipFile(GithubURLRetrieverMixin, RequiredLatestFromWeb
     """
     This class fetches a ZIP file from Github and extracts it.
     """
+    def __init__(
+        self,
+        url,
+        save_as,
+        file_to_check,
+        skip_initial_dir=True,
+        background_update=False,
+        keep_versions=2,
+        update_interval=3600,
+        delta_url=None,
+    ):
+        save_as = self._latest_init(save_as, background_update, keep_versions, update_interval, delta_url)
+        super().__init__(url, save_as, file_to_check, skip_initial_dir)
+
     def _should_i_skip_this_filename(self, filename):
         retVal = not filename.lower().endswith('.zip')
         LOGGER.debug(f'RequiredLatestGithubZipFile._should_i_skip_this_filename:: {retVal}')
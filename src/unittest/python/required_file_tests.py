@@ -1,8 +1,14 @@
+import gzip
+import io
+import os
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from unittest import TestCase, main, mock, skipIf
 
-from common import URL_RAW, URL_UNKNOWN, TEST_STRING
+import requests
+import urllib3
+
+from common import URL_RAW, URL_UNKNOWN, TEST_STRING, TESTFILE_NAME
 from required_files.required_files import RequiredFile, FileAdapter
 
 
@@ -101,6 +107,55 @@ class TestRequiredFile(TestCase):
         with self.assertRaises(ValueError):
             RequiredFile._download_to_tmpfile(URL_UNKNOWN)
 
+    @skipIf(not FileAdapter, '`FileAdapter` is not available')
+    def test__download_broken_transfer_leaves_nothing(self):
+        def broken_transfer(response, chunk_size):
+            yield b'Test'
+            raise requests.exceptions.ChunkedEncodingError('Connection broken')
+
+        target = Path(self.tmpDir.name) / 'target.tmp'
+        url = (Path(__file__).absolute().parent.parent / 'resources' / TESTFILE_NAME).as_uri()
+        with mock.patch.object(requests.Response, 'iter_content', broken_transfer):
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                RequiredFile(url, target).check()
+
+        self.assertEqual(list(Path(self.tmpDir.name).iterdir()), [])
+        self.assertEqual(Path(RequiredFile(url, target).check()).read_text(), TEST_STRING)
+
+    @skipIf(not FileAdapter, '`FileAdapter` is not available')
+    @skipIf(os.name == 'nt', 'No POSIX permissions')
+    def test__download_respects_umask(self):
+        target = Path(self.tmpDir.name) / 'target.tmp'
+        url = (Path(__file__).absolute().parent.parent / 'resources' / TESTFILE_NAME).as_uri()
+        umask = os.umask(0o022)
+        try:
+            RequiredFile(url, target).check()
+        finally:
+            os.umask(umask)
+
+        self.assertEqual(target.stat().st_mode & 0o777, 0o644)
+
+    @mock.patch('required_files.required_files.CHUNK_SIZE', 64)
+    def test__download_decodes_gzip_while_streaming(self):
+        body = (TEST_STRING * 100).encode('utf8')
+
+        def send(adapter, request, **kwargs):
+            raw = urllib3.HTTPResponse(
+                body=io.BytesIO(gzip.compress(body)),
+                headers={'Content-Encoding': 'gzip'},
+                status=200,
+                preload_content=False,
+            )
+            return adapter.build_response(request, raw)
+
+        save_to = mock.Mock(wraps=io.BytesIO())
+        with mock.patch.object(requests.adapters.HTTPAdapter, 'send', send):
+            RequiredFile._download(URL_RAW, save_to)
+
+        self.assertEqual(b''.join(c[0][0] for c in save_to.write.call_args_list), body)
+        self.assertGreater(save_to.write.call_count, 1)
+        self.assertTrue(all(len(c[0][0]) <= 64 for c in save_to.write.call_args_list))
+
 
 if __name__ == '__main__':
     main()
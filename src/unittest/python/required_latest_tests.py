@@ -0,0 +1,411 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main, mock, skipIf
+
+from common import TESTFILE_NAME, TEST_STRING
+from required_files import RequiredLatestBitbucketFile, RequiredLatestGithubZipFile
+from required_files.required_files import (
+    BitBucketURLRetrieverMixin,
+    FileAdapter,
+    RequiredFile,
+    RequiredLatestFromWebMixin,
+    _join_update_threads,
+    bsdiff4,
+    zstandard,
+)
+
+RESOURCES = Path(__file__).absolute().parent.parent / 'resources'
+FILE_URL_RAW = (RESOURCES / TESTFILE_NAME).as_uri()
+FILE_URL_ZIP_WITH_SINGLE_DIR = (RESOURCES / 'zip_with_single_directory.zip').as_uri()
+FILE_URL_ZIP_WITHOUT_DIR = (RESOURCES / 'zip_without_directories.zip').as_uri()
+FILE_URL_ZIP_WITH_DIR_STRUCTURE = (RESOURCES / 'zip_with_dir_structure.zip').as_uri()
+
+
+@skipIf(not FileAdapter, '`FileAdapter` is not available')
+class TestBackgroundUpdate(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        self.versions_dir = Path(self.tmp_dir.name) / 'bin.versions'
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+        del self.tmp_dir
+
+    def _github(self, **kwargs):
+        return RequiredLatestGithubZipFile(
+            'https://github.com/org/project/releases/latest',
+            Path(self.tmp_dir.name) / 'bin',
+            TESTFILE_NAME,
+            background_update=True,
+            update_interval=0,
+            **kwargs
+        )
+
+    def _current_version(self):
+        return os.readlink(self.versions_dir / 'current')
+
+    def test_first_check_installs_synchronously(self):
+        with mock.patch.object(RequiredLatestGithubZipFile, 'figure_out_url', return_value=FILE_URL_ZIP_WITHOUT_DIR):
+            required = self._github()
+            result = Path(required.check())
+
+        self.assertEqual(result, (self.versions_dir / 'current' / 'bin').absolute())
+        self.assertEqual((result / TESTFILE_NAME).read_text(), TEST_STRING)
+        self.assertIsNone(required._update_thread)
+        self.assertFalse((Path(self.tmp_dir.name) / 'bin').exists())
+
+    @skipIf(os.name == 'nt', 'No POSIX permissions')
+    def test_version_directory_respects_umask(self):
+        required = self._github()
+        umask = os.umask(0o022)
+        try:
+            with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_ZIP_WITHOUT_DIR):
+                required.check()
+        finally:
+            os.umask(umask)
+
+        self.assertEqual((self.versions_dir / self._current_version()).stat().st_mode & 0o777, 0o755)
+
+    def test_new_release_is_switched_in_background(self):
+        required = self._github()
+        with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_ZIP_WITHOUT_DIR):
+            result = required.check()
+        old_version = self._current_version()
+
+        with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_ZIP_WITH_SINGLE_DIR):
+            self.assertEqual(required.check(), result)
+            required._update_thread.join()
+
+        self.assertNotEqual(self._current_version(), old_version)
+        self.assertTrue((self.versions_dir / old_version).exists())
+        self.assertEqual((Path(result) / TESTFILE_NAME).read_text(), TEST_STRING)
+        self.assertEqual(required.url, 'https://github.com/org/project/releases/latest')
+
+    def test_old_versions_are_garbage_collected(self):
+        required = self._github(keep_versions=1)
+        self.assertEqual(required.keep_versions, 2)
+
+        versions = []
+        for url in (FILE_URL_ZIP_WITHOUT_DIR, FILE_URL_ZIP_WITH_SINGLE_DIR, FILE_URL_ZIP_WITH_DIR_STRUCTURE):
+            with mock.patch.object(required, 'figure_out_url', return_value=url):
+                required.check()
+                if required._update_thread:
+                    required._update_thread.join()
+            versions.append(self._current_version())
+
+        self.assertEqual(len(set(versions)), 3)
+        self.assertFalse((self.versions_dir / versions[0]).exists())
+        self.assertTrue((self.versions_dir / versions[1]).exists())
+        self.assertTrue((self.versions_dir / versions[2]).exists())
+
+    def test_no_update_within_interval(self):
+        required = self._github()
+        required.update_interval = 3600
+        with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_ZIP_WITHOUT_DIR):
+            required.check()
+            required.check()
+
+        self.assertIsNone(required._update_thread)
+
+    def test_failed_update_respects_interval(self):
+        required = self._github()
+        required.update_interval = 3600
+        with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_ZIP_WITHOUT_DIR):
+            required.check()
+        os.utime(self.versions_dir / '.last-update', (0, 0))
+
+        with mock.patch.object(required, 'figure_out_url', side_effect=ValueError('rate limited')) as figure_out_url:
+            required.check()
+            thread = required._update_thread
+            thread.join()
+            required.check()
+
+        self.assertIs(required._update_thread, thread)
+        self.assertEqual(figure_out_url.call_count, 1)
+
+    def test_failed_background_update_keeps_current(self):
+        required = self._github()
+        with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_ZIP_WITHOUT_DIR):
+            result = required.check()
+        old_version = self._current_version()
+
+        with mock.patch.object(required, 'figure_out_url', side_effect=ValueError('no release')):
+            self.assertEqual(required.check(), result)
+            required._update_thread.join()
+
+        self.assertEqual(self._current_version(), old_version)
+        self.assertEqual([p.name for p in self.versions_dir.iterdir() if p.name.startswith('.tmp-')], [])
+
+    def test_running_update_is_joined_at_exit(self):
+        required = self._github()
+        with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_ZIP_WITHOUT_DIR):
+            required.check()
+        old_version = self._current_version()
+
+        def slow_release(url):
+            time.sleep(0.2)
+            return FILE_URL_ZIP_WITH_SINGLE_DIR
+
+        with mock.patch.object(required, 'figure_out_url', side_effect=slow_release):
+            required.check()
+            _join_update_threads()
+
+        self.assertFalse(required._update_thread.is_alive())
+        self.assertNotEqual(self._current_version(), old_version)
+
+    def test_leftovers_of_dead_updates_are_collected(self):
+        required = self._github()
+        with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_ZIP_WITHOUT_DIR):
+            required.check()
+
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        stale_dir = self.versions_dir / f'.tmp-{process.pid}-abc'
+        (stale_dir / 'bin').mkdir(parents=True)
+        stale_link = self.versions_dir / f'.current-{process.pid}-1'
+        stale_link.symlink_to(self._current_version())
+        own_dir = self.versions_dir / f'.tmp-{os.getpid()}-abc'
+        own_dir.mkdir()
+
+        required._collect_garbage()
+
+        self.assertFalse(stale_dir.exists())
+        self.assertFalse(os.path.lexists(stale_link))
+        self.assertFalse(own_dir.exists())
+        self.assertTrue((self.versions_dir / '.last-update').exists())
+        self.assertTrue((self.versions_dir / 'current').exists())
+
+    def test_bitbucket_file(self):
+        required = RequiredLatestBitbucketFile(
+            'https://bitbucket.org/org/project/downloads/',
+            Path(self.tmp_dir.name) / 'bin',
+            r'.*\.txt',
+            background_update=True,
+        )
+        with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_RAW):
+            result = Path(required.check())
+
+        self.assertEqual(result, (self.versions_dir / 'current' / 'bin').absolute())
+        self.assertEqual(result.read_text(), TEST_STRING)
+
+
+@skipIf(not FileAdapter, '`FileAdapter` is not available')
+class TestCustomSubclass(TestCase):
+    class RequiredLatestTxtFile(BitBucketURLRetrieverMixin, RequiredLatestFromWebMixin, RequiredFile):
+        def __init__(self, url, save_as):
+            super().__init__(url, save_as)
+
+        def _should_i_skip_this_filename(self, filename):
+            return not filename.endswith('.txt')
+
+    def test_without_latest_init(self):
+        with TemporaryDirectory() as tmp_dir:
+            target = Path(tmp_dir) / 'bin' / TESTFILE_NAME
+            required = self.RequiredLatestTxtFile('https://bitbucket.org/org/project/downloads/', target)
+            with mock.patch.object(required, 'figure_out_url', return_value=FILE_URL_RAW):
+                self.assertEqual(Path(required.check()), target.absolute())
+
+            self.assertEqual(target.read_text(), TEST_STRING)
+            self.assertEqual(required.url, FILE_URL_RAW)
+
+
+@skipIf(not FileAdapter, '`FileAdapter` is not available')
+class TestDeltaUpdate(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        self.releases = Path(self.tmp_dir.name) / 'releases'
+        self.releases.mkdir()
+        self.old_release = self.releases / 'old.zip'
+        self.new_release = self.releases / 'new.zip'
+        shutil.copyfile(RESOURCES / 'zip_without_directories.zip', self.old_release)
+        shutil.copyfile(RESOURCES / 'zip_with_single_directory.zip', self.new_release)
+        self.versions_dir = Path(self.tmp_dir.name) / 'bin.versions'
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+        del self.tmp_dir
+
+    @staticmethod
+    def _publish_digest(release):
+        digest = hashlib.sha256(release.read_bytes()).hexdigest()
+        Path(f'{release}.sha256').write_text(f'{digest}  {release.name}\n')
+        return Path(f'{release}.sha256').as_uri()
+
+    def _upgrade(self, delta_url):
+        required = RequiredLatestGithubZipFile(
+            'https://github.com/org/project/releases/latest',
+            Path(self.tmp_dir.name) / 'bin',
+            TESTFILE_NAME,
+            background_update=True,
+            update_interval=0,
+            delta_url=delta_url,
+        )
+        with mock.patch.object(required, 'figure_out_url', return_value=self.old_release.as_uri()):
+            result = Path(required.check())
+
+        with mock.patch.object(required, 'figure_out_url', return_value=self.new_release.as_uri()), \
+                mock.patch.object(RequiredFile, '_download', wraps=RequiredFile._download) as download:
+            required.check()
+            required._update_thread.join()
+
+        current = self.versions_dir / 'current'
+        self.assertEqual((current / required.ARCHIVE).read_bytes(), self.new_release.read_bytes())
+        self.assertEqual((current / required.SOURCE_URL).read_text(), self.new_release.as_uri())
+        self.assertEqual((result / TESTFILE_NAME).read_text(), TEST_STRING)
+        return [c[0][0] for c in download.call_args_list]
+
+    @skipIf(not zstandard, '`zstandard` is not available')
+    def test_zstd_patch(self):
+        dictionary = zstandard.ZstdCompressionDict(
+            self.old_release.read_bytes(), dict_type=zstandard.DICT_TYPE_RAWCONTENT
+        )
+        patch = zstandard.ZstdCompressor(dict_data=dictionary).compress(self.new_release.read_bytes())
+        (self.releases / 'new.zip.from-old.zip.zst').write_bytes(patch)
+        digest_url = self._publish_digest(self.new_release)
+
+        downloaded = self._upgrade('{url}.from-{old_name}.zst')
+        self.assertEqual(downloaded, [digest_url, (self.releases / 'new.zip.from-old.zip.zst').as_uri()])
+
+    @skipIf(not bsdiff4, '`bsdiff4` is not available')
+    def test_bsdiff_patch(self):
+        patch = bsdiff4.diff(self.old_release.read_bytes(), self.new_release.read_bytes())
+        (self.releases / 'old-to-new.bsdiff').write_bytes(patch)
+        digest_url = self._publish_digest(self.new_release)
+
+        downloaded = self._upgrade('file://' + str(self.releases) + '/{old_name:.3}-to-{name:.3}.bsdiff')
+        self.assertEqual(downloaded, [digest_url, (self.releases / 'old-to-new.bsdiff').as_uri()])
+
+    @skipIf(not zstandard, '`zstandard` is not available')
+    def test_patch_with_wrong_result_falls_back_to_full_download(self):
+        dictionary = zstandard.ZstdCompressionDict(
+            self.old_release.read_bytes(), dict_type=zstandard.DICT_TYPE_RAWCONTENT
+        )
+        patch = zstandard.ZstdCompressor(dict_data=dictionary).compress(self.new_release.read_bytes() + b'garbage')
+        (self.releases / 'new.zip.from-old.zip.zst').write_bytes(patch)
+        digest_url = self._publish_digest(self.new_release)
+
+        downloaded = self._upgrade('{url}.from-{old_name}.zst')
+        self.assertEqual(
+            downloaded,
+            [digest_url, (self.releases / 'new.zip.from-old.zip.zst').as_uri(), self.new_release.as_uri()],
+        )
+
+    @skipIf(not zstandard, '`zstandard` is not available')
+    def test_patch_without_digest_falls_back_to_full_download(self):
+        dictionary = zstandard.ZstdCompressionDict(
+            self.old_release.read_bytes(), dict_type=zstandard.DICT_TYPE_RAWCONTENT
+        )
+        patch = zstandard.ZstdCompressor(dict_data=dictionary).compress(self.new_release.read_bytes())
+        (self.releases / 'new.zip.from-old.zip.zst').write_bytes(patch)
+
+        downloaded = self._upgrade('{url}.from-{old_name}.zst')
+        self.assertEqual(downloaded, [Path(f'{self.new_release}.sha256').as_uri(), self.new_release.as_uri()])
+
+    @skipIf(not bsdiff4, '`bsdiff4` is not available')
+    def test_patch_for_another_base_falls_back_to_full_download(self):
+        v1, v2, v3 = (self.releases / f'v{i}.txt' for i in range(1, 4))
+        v1.write_text('Version 1 of the tool')
+        v2.write_text('Version 2 of the tool')
+        v3.write_text('Version 3 of the tool')
+        Path(f'{v3}.bsdiff').write_bytes(bsdiff4.diff(v2.read_bytes(), v3.read_bytes()))  # A week was skipped.
+        self._publish_digest(v3)
+
+        # This patch URL doesn't tell from which release the patch starts.
+        required = RequiredLatestBitbucketFile(
+            'https://bitbucket.org/org/project/downloads/',
+            Path(self.tmp_dir.name) / 'bin',
+            r'.*\.txt',
+            background_update=True,
+            update_interval=0,
+            delta_url='{url}.bsdiff',
+        )
+        with mock.patch.object(required, 'figure_out_url', return_value=v1.as_uri()):
+            result = Path(required.check())
+
+        with mock.patch.object(required, 'figure_out_url', return_value=v3.as_uri()):
+            required.check()
+            required._update_thread.join()
+
+        self.assertEqual(result.read_text(), 'Version 3 of the tool')
+
+    @skipIf(not bsdiff4, '`bsdiff4` is not available')
+    def test_changed_installation_does_not_corrupt_the_delta_base(self):
+        old_release, new_release = self.releases / 'v1' / 'tool.txt', self.releases / 'v2' / 'tool.txt'
+        old_release.parent.mkdir()
+        new_release.parent.mkdir()
+        old_release.write_text(TEST_STRING)
+        new_release.write_text(TEST_STRING + ' Really!')
+        patch = bsdiff4.diff(old_release.read_bytes(), new_release.read_bytes())
+        (self.releases / 'v2' / 'tool.txt.from-v1.bsdiff').write_bytes(patch)
+        self._publish_digest(new_release)
+
+        required = RequiredLatestBitbucketFile(
+            'https://bitbucket.org/org/project/downloads/',
+            Path(self.tmp_dir.name) / 'bin',
+            r'.*\.txt',
+            background_update=True,
+            update_interval=0,
+            delta_url='{url}.from-{old_tag}.bsdiff',
+        )
+        with mock.patch.object(required, 'figure_out_url', return_value=old_release.as_uri()):
+            result = Path(required.check())
+
+        with open(result, 'r+b') as fp:  # Edited in place.
+            fp.write(b'Tset')
+
+        self.assertEqual((self.versions_dir / 'current' / required.ARCHIVE).read_text(), TEST_STRING)
+
+        with mock.patch.object(required, 'figure_out_url', return_value=new_release.as_uri()), \
+                mock.patch.object(RequiredFile, '_download', wraps=RequiredFile._download) as download:
+            required.check()
+            required._update_thread.join()
+
+        self.assertNotIn(new_release.as_uri(), [c[0][0] for c in download.call_args_list])
+        self.assertEqual(result.read_text(), TEST_STRING + ' Really!')
+
+    def test_changed_delta_base_falls_back_to_full_download(self):
+        required = RequiredLatestGithubZipFile(
+            'https://github.com/org/project/releases/latest',
+            Path(self.tmp_dir.name) / 'bin',
+            TESTFILE_NAME,
+            background_update=True,
+            update_interval=0,
+            delta_url='{url}.from-{old_name}.zst',
+        )
+        with mock.patch.object(required, 'figure_out_url', return_value=self.old_release.as_uri()):
+            required.check()
+
+        with open(self.versions_dir / 'current' / required.ARCHIVE, 'ab') as fp:
+            fp.write(b'changed')
+
+        with mock.patch.object(required, 'figure_out_url', return_value=self.new_release.as_uri()), \
+                mock.patch.object(RequiredLatestGithubZipFile, '_download_to_tmpfile') as download_patch:
+            required.check()
+            required._update_thread.join()
+
+        self.assertFalse(download_patch.called)
+        self.assertEqual(
+            (self.versions_dir / 'current' / required.ARCHIVE).read_bytes(), self.new_release.read_bytes()
+        )
+
+    def test_missing_patch_falls_back_to_full_download(self):
+        digest_url = self._publish_digest(self.new_release)
+        downloaded = self._upgrade('{url}.from-{old_name}.zst')
+        self.assertEqual(
+            downloaded,
+            [digest_url, (self.releases / 'new.zip.from-old.zip.zst').as_uri(), self.new_release.as_uri()],
+        )
+
+    def test_unknown_patch_format_falls_back_to_full_download(self):
+        downloaded = self._upgrade('{url}.patch')
+        self.assertEqual(downloaded, [self.new_release.as_uri()])
+
+
+if __name__ == '__main__':
+    main()